@@ -0,0 +1,192 @@
+"""
+Admission control for tasks handled by the sqsd endpoint.
+
+When a task is rejected, the endpoint responds with an error status right away.
+SQS daemon does not delete the message in this case, so it becomes visible again after
+the queue's visibility timeout and is redelivered later, instead of timing out on an overloaded instance.
+
+State is kept per process.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+DEFAULT_CIRCUIT_BREAKER_RESET_SECONDS = 60
+
+_lock = threading.Lock()
+_running_total = 0
+_running_by_task = defaultdict(int)
+_breakers = {}
+
+
+class TaskRejected(Exception):
+    """
+    Raised when the task is not admitted to run. status_code is returned to sqsd.
+    """
+    status_code = 503
+
+
+class ConcurrencyLimitExceeded(TaskRejected):
+    pass
+
+
+class TaskConcurrencyLimitExceeded(ConcurrencyLimitExceeded):
+    status_code = 429
+
+
+class CircuitOpen(TaskRejected):
+    pass
+
+
+class Admission:
+    """
+    Slot reserved by admit(), must be passed to release().
+    is_trial is True for the single run let through by a half-open circuit breaker.
+    """
+
+    __slots__ = ("task_name", "is_trial")
+
+    def __init__(self, task_name, is_trial=False):
+        self.task_name = task_name
+        self.is_trial = is_trial
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures of the task and rejects it for reset_seconds.
+    After that a single trial run is let through: if it succeeds the breaker closes, otherwise it opens again.
+    While the breaker is open only the trial decides its state, outcomes of runs admitted before
+    it opened are ignored.
+    Not thread-safe on its own, used under the module lock.
+    """
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        :return: tuple of (True if the task may run now, True if this run is the trial)
+        """
+        if not self.is_open():
+            return True, False
+
+        if self.trial_running or time.monotonic() - self.opened_at < self.reset_seconds:
+            return False, False
+
+        # half-open: let one run through to check if the task recovered
+        self.trial_running = True
+        return True, True
+
+    def record_success(self, is_trial):
+        if self.is_open() and not is_trial:
+            # late success of a run admitted before the breaker opened
+            return
+
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self, is_trial):
+        if self.is_open():
+            if is_trial:
+                self.trial_running = False
+                self.opened_at = time.monotonic()
+            # late failures of runs admitted before the breaker opened don't change anything
+            return
+
+        self.failures += 1
+
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+def _get_breaker(task_name):
+    failure_threshold = getattr(settings, "AWS_EB_CIRCUIT_BREAKER_FAILURE_THRESHOLD", None)
+    if not failure_threshold:
+        return None
+
+    breaker = _breakers.get(task_name)
+    if breaker is None:
+        reset_seconds = getattr(settings, "AWS_EB_CIRCUIT_BREAKER_RESET_SECONDS", DEFAULT_CIRCUIT_BREAKER_RESET_SECONDS)
+        breaker = _breakers[task_name] = CircuitBreaker(failure_threshold, reset_seconds)
+
+    return breaker
+
+
+def admit(task_name, max_task_concurrency=None):
+    """
+    Reserves a slot for the task. Every successful call must be followed by release() of the returned admission.
+
+    :param task_name: name of the task
+    :param max_task_concurrency: maximum number of concurrently running instances of this task
+    in the process, set with @task(max_concurrency=...)
+    :return: Admission
+    :raises TaskRejected: if the task should be shed
+    """
+    global _running_total
+
+    max_concurrency = getattr(settings, "AWS_EB_MAX_CONCURRENT_TASKS", None)
+
+    with _lock:
+        if max_concurrency and _running_total >= max_concurrency:
+            raise ConcurrencyLimitExceeded(f"{_running_total} tasks are already running in this process, "
+                                           f"limit is {max_concurrency}")
+
+        if max_task_concurrency and _running_by_task[task_name] >= max_task_concurrency:
+            raise TaskConcurrencyLimitExceeded(f"{_running_by_task[task_name]} instances of task {task_name} are "
+                                               f"already running in this process, limit is {max_task_concurrency}")
+
+        is_trial = False
+        breaker = _get_breaker(task_name)
+        if breaker is not None:
+            allowed, is_trial = breaker.allow()
+            if not allowed:
+                raise CircuitOpen(f"Circuit breaker of task {task_name} is open after {breaker.failures} failures")
+
+        _running_total += 1
+        _running_by_task[task_name] += 1
+
+    return Admission(task_name, is_trial)
+
+
+def release(admission, success):
+    """
+    Frees the slot reserved by admit() and records the outcome of the task for its circuit breaker.
+    """
+    global _running_total
+
+    task_name = admission.task_name
+
+    with _lock:
+        _running_total -= 1
+        _running_by_task[task_name] -= 1
+        if not _running_by_task[task_name]:
+            del _running_by_task[task_name]
+
+        breaker = _get_breaker(task_name)
+        if breaker is not None:
+            if success:
+                breaker.record_success(admission.is_trial)
+            else:
+                breaker.record_failure(admission.is_trial)
+
+
+def reset():
+    """
+    Forgets all running tasks and circuit breakers state.
+    """
+    global _running_total
+
+    with _lock:
+        _running_total = 0
+        _running_by_task.clear()
+        _breakers.clear()
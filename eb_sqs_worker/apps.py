@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class EbSqsConfig(AppConfig):
     name = 'eb_sqs_worker'
+
+    def ready(self):
+        from eb_sqs_worker import log
+
+        # fail on startup instead of falling back to default level for every message
+        if getattr(settings, "AWS_EB_LOG_LEVEL", None) is not None:
+            log.parse_log_level(settings.AWS_EB_LOG_LEVEL)
@@ -0,0 +1,230 @@
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+
+from eb_sqs_worker import log
+from eb_sqs_worker import sqs
+from eb_sqs_worker import worker
+from eb_sqs_worker.sqs import SQSTask
+
+logger = logging.getLogger(__name__)
+
+
+class WeightedQueuePoller:
+    """
+    Polls queues defined in settings.AWS_EB_PRIORITY_QUEUES and runs received tasks in this process.
+
+    Queues are picked using smooth weighted round-robin with weights from settings.AWS_EB_PRIORITY_WEIGHTS,
+    e.g. with weights {"high": 3, "low": 1} the poller turns to "high" queue three times as often as
+    to "low" queue, but "low" is never starved. Empty queues are skipped, so when only one lane has
+    messages it gets all the throughput.
+
+    Messages are received in batches, but between the messages of a batch the poller checks lanes with
+    higher weight and runs one message from them first, so a batch of slow low priority tasks delays
+    a high priority task by at most one task. Visibility of messages waiting in the local batch is extended
+    before every task, so other pollers don't receive them again in the meantime.
+
+    Messages are deleted only after the task finishes successfully; failed tasks become visible again
+    after the queue's visibility timeout and are redelivered (or moved to the dead-letter queue by SQS).
+    """
+
+    def __init__(self, priorities=None, max_messages=10, wait_time_seconds=5, queues=None):
+        """
+        :param priorities: names of priorities to poll, defaults to all priorities in settings.AWS_EB_PRIORITY_QUEUES
+        :param max_messages: maximum number of messages received from a queue in one turn (1-10)
+        :param wait_time_seconds: long polling time used when all queues are empty
+        :param queues: dictionary of priority name to SQS.Queue instance, looked up by name if not set
+        """
+        priority_queues = getattr(settings, "AWS_EB_PRIORITY_QUEUES", None) or {}
+
+        if priorities is None:
+            priorities = list(priority_queues.keys())
+
+        if not priorities:
+            raise ImproperlyConfigured("settings.AWS_EB_PRIORITY_QUEUES must be set to poll priority queues")
+
+        for priority in priorities:
+            if priority not in priority_queues:
+                raise ImproperlyConfigured(f"Priority {priority} is not defined in settings.AWS_EB_PRIORITY_QUEUES")
+
+        if not 1 <= max_messages <= sqs.SQS_MAX_BATCH_ENTRIES:
+            # SQS rejects receive and visibility batch requests with more entries
+            raise ValueError(f"max_messages must be between 1 and {sqs.SQS_MAX_BATCH_ENTRIES}, got {max_messages}")
+
+        weights = getattr(settings, "AWS_EB_PRIORITY_WEIGHTS", None) or {}
+
+        self.priorities = list(priorities)
+        self.weights = {priority: weights.get(priority, 1) for priority in self.priorities}
+        self.current_weights = {priority: 0 for priority in self.priorities}
+        self.max_messages = max_messages
+        self.wait_time_seconds = wait_time_seconds
+
+        if queues is None:
+            queues = {priority: sqs.get_queue(priority_queues[priority]) for priority in self.priorities}
+        self.queues = queues
+
+        # the queue's own visibility timeout is kept when extending visibility of waiting messages
+        self.visibility_timeouts = {priority: int(queue.attributes.get("VisibilityTimeout", 30))
+                                    for priority, queue in self.queues.items()}
+
+        # messages received, but not run yet, by priority
+        self.waiting_messages = {priority: [] for priority in self.priorities}
+
+    def next_priority(self):
+        """
+        :return: name of the priority whose queue should be polled next
+        """
+        total_weight = 0
+        best_priority = None
+
+        for priority in self.priorities:
+            self.current_weights[priority] += self.weights[priority]
+            total_weight += self.weights[priority]
+
+            if best_priority is None or self.current_weights[priority] > self.current_weights[best_priority]:
+                best_priority = priority
+
+        self.current_weights[best_priority] -= total_weight
+
+        return best_priority
+
+    def poll_once(self):
+        """
+        Receives a batch of messages from the next non-empty queue and runs them.
+        If all queues are empty, waits for messages on the heaviest queue using long polling.
+        :return: number of processed messages
+        """
+        chosen_priority = self.next_priority()
+        # if the chosen queue is empty, other queues are tried in order of their weights
+        other_priorities = sorted((p for p in self.priorities if p != chosen_priority),
+                                  key=lambda p: self.weights[p], reverse=True)
+
+        for priority in [chosen_priority] + other_priorities:
+            messages = self.queues[priority].receive_messages(MaxNumberOfMessages=self.max_messages,
+                                                              WaitTimeSeconds=0)
+            if messages:
+                return self.process_messages(priority, messages)
+
+        heaviest_priority = max(self.priorities, key=lambda p: self.weights[p])
+        messages = self.queues[heaviest_priority].receive_messages(MaxNumberOfMessages=self.max_messages,
+                                                                   WaitTimeSeconds=self.wait_time_seconds)
+        return self.process_messages(heaviest_priority, messages)
+
+    def process_messages(self, priority, messages):
+        """
+        Runs received messages one by one, letting a message from a lane with higher weight run
+        between them.
+        :return: number of processed messages, including the ones from higher lanes
+        """
+        waiting = self.waiting_messages[priority]
+        waiting.extend(messages)
+
+        processed = 0
+
+        while waiting:
+            # the message about to run is still in the batch, so its visibility is extended as well
+            self.extend_visibility()
+            message = waiting.pop(0)
+            self.process_message(priority, message)
+            processed += 1
+
+            if waiting:
+                processed += self.process_higher_priority_message(priority)
+
+        return processed
+
+    def process_higher_priority_message(self, priority):
+        """
+        Runs one message from the heaviest non-empty lane that has higher weight than the priority.
+        :return: number of processed messages
+        """
+        higher_priorities = sorted((p for p in self.priorities if self.weights[p] > self.weights[priority]),
+                                   key=lambda p: self.weights[p], reverse=True)
+
+        for higher_priority in higher_priorities:
+            messages = self.queues[higher_priority].receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=0)
+            if messages:
+                return self.process_messages(higher_priority, messages)
+
+        return 0
+
+    def extend_visibility(self):
+        """
+        Resets visibility timeout of all messages in local batches, including the one about to run,
+        so they are not received by other pollers while this one runs the next task.
+        """
+        for priority, messages in self.waiting_messages.items():
+            if not messages:
+                continue
+
+            entries = [{"Id": str(index),
+                        "ReceiptHandle": message.receipt_handle,
+                        "VisibilityTimeout": self.visibility_timeouts[priority]}
+                       for index, message in enumerate(messages)]
+
+            try:
+                self.queues[priority].change_message_visibility_batch(Entries=entries)
+            except Exception as e:
+                logger.warning(f"Failed to extend visibility of {len(entries)} waiting messages "
+                               f"from {priority} priority queue: {e}", exc_info=True)
+
+    def process_message(self, priority, message):
+        """
+        Runs the task from the message and deletes the message if the task succeeded.
+        :return: True if the task succeeded
+        """
+        call_id = uuid.uuid4().hex
+
+        try:
+            task = SQSTask(json.loads(message.body))
+        except Exception as e:
+            logger.error(f"[{call_id}] Failed to parse message {message.message_id} "
+                         f"from {priority} priority queue: {e}", exc_info=True)
+            return False
+
+        log_level, sample_rate = task.get_log_options()
+        log_enabled = logger.isEnabledFor(log_level) and log.is_sampled(sample_rate)
+
+        if log_enabled:
+            logger.log(log_level, "[%s] Received %s from %s priority queue", call_id, task, priority)
+
+        # there is no request cycle here, so do what django does on request start and finish:
+        # drop connections that are broken or older than CONN_MAX_AGE and keep healthy ones open between tasks
+        close_old_connections()
+
+        start_time = time.time()
+
+        try:
+            worker.task_started(task)
+            result = task.run_task()
+        except Exception as e:
+            worker.task_finished(task, exception=e)
+            close_old_connections()
+            logger.error(f"[{call_id}] Task {task.task_name} failed, leaving message {message.message_id} "
+                         f"for redelivery: {e}", exc_info=True)
+            return False
+
+        worker.task_finished(task, result=result)
+        close_old_connections()
+
+        execution_time = time.time() - start_time
+
+        if log_enabled:
+            logger.log(log_level, "[%s] Finished %s. Result: %s. Execution time: %ss.",
+                       call_id, task, log.LazyRepr(result), execution_time)
+
+        message.delete()
+
+        return True
+
+    def run(self):
+        """
+        Polls queues forever.
+        """
+        while True:
+            self.poll_once()
@@ -5,12 +5,14 @@ from functools import wraps
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from eb_sqs_worker import log
 from eb_sqs_worker import sqs
 
 logger = logging.getLogger(__name__)
 
 
-def task(function=None, run_locally=None, queue_name=None, task_name=None):
+def task(function=None, run_locally=None, queue_name=None, task_name=None, log_level=None, log_sample_rate=None,
+         priority=None, max_concurrency=None):
     """
     Decorate functions with this decorator to automatically register them in AWS_EB_ENABLED_TASKS.
     Don't supply positional arguments, use only keyword arguments, otherwise the decorator will work.
@@ -19,6 +21,14 @@ def task(function=None, run_locally=None, queue_name=None, task_name=None):
     :param run_locally:
     :param queue_name:
     :param task_name:
+    :param log_level: level of routine "received/finished" log records for this task,
+    overrides settings.AWS_EB_LOG_LEVEL. Can be a number or a level name, e.g. "DEBUG".
+    :param log_sample_rate: fraction of messages of this task that get routine log records,
+    overrides settings.AWS_EB_LOG_SAMPLE_RATE. Useful for high-volume tasks.
+    :param priority: name of the priority lane from settings.AWS_EB_PRIORITY_QUEUES,
+    the task will be sent to the corresponding queue. Ignored if queue_name is set.
+    :param max_concurrency: maximum number of instances of this task running at the same time
+    in one worker process, messages over the limit are rejected by the sqsd endpoint with 429 status.
     :return:
     """
 
@@ -33,7 +43,13 @@ def task(function=None, run_locally=None, queue_name=None, task_name=None):
         task_function_execution_path = f"{f.__module__}.{f.__name__}"
 
         logger.info(f"eb-sqs-worker: registering task {f} with decorator under name {task_name_to_use}; "
-                    f"Overrides: run_locally: {run_locally}, queue_name: {queue_name}, task_name: {task_name}")
+                    f"Overrides: run_locally: {run_locally}, queue_name: {queue_name}, task_name: {task_name}, "
+                    f"log_level: {log_level}, log_sample_rate: {log_sample_rate}, priority: {priority}, "
+                    f"max_concurrency: {max_concurrency}")
+
+        if log_level is not None:
+            # raises ImproperlyConfigured on import instead of falling back to default level for every message
+            log.parse_log_level(log_level)
 
         if hasattr(settings, "AWS_EB_ENABLED_TASKS"):
             if settings.AWS_EB_ENABLED_TASKS.get(task_name_to_use):
@@ -56,7 +72,8 @@ def task(function=None, run_locally=None, queue_name=None, task_name=None):
         # we do this instead of adding traditional delay function,
         # so that the IDEs autocompletion for kwargs will work everywhere
         task_function = lambda **kwargs: sqs.send_task(task_name=task_name_to_use, task_kwargs=kwargs,
-                                                       run_locally=run_locally, queue_name=queue_name)
+                                                       run_locally=run_locally, queue_name=queue_name,
+                                                       priority=priority)
 
         # add sync() method to this function, so the function can be called directly
         # this is needed for two reasons:
@@ -64,12 +81,31 @@ def task(function=None, run_locally=None, queue_name=None, task_name=None):
         # 2. So it can be run syncronously by developer somewhere in the code if needed.
         f.execute = lambda **kwargs: f(**kwargs)
 
+        # registered name and routing, so the task can be referenced and sent e.g. as a reduce task of chunks()
+        f.task_name = task_name_to_use
+        f.run_locally = run_locally
+        f.queue_name = queue_name
+        f.priority = priority
+
+        # logging options are looked up by the sender and the worker through the registered function
+        f.log_level = log_level
+        f.log_sample_rate = log_sample_rate
+
+        # checked by the sqsd endpoint before running the task
+        f.max_concurrency = max_concurrency
 
         @wraps(f)
         def wrapper(**kwargs):  # task functions cannot have *args, only **kwargs
             # **kwargs here are the kwargs of the decorated function
             return task_function(**kwargs)
 
+        # add chunks() method to fan out over large iterables of kwargs in fixed-size chunk tasks.
+        # reduce_task can be another decorated task (or its name) that receives a list of results of every chunk
+        wrapper.chunks = lambda kwargs_iterable, size, reduce_task=None: sqs.send_task_chunks(
+            task_name=task_name_to_use, kwargs_iterable=kwargs_iterable, chunk_size=size,
+            run_locally=run_locally, queue_name=queue_name, priority=priority,
+            reduce_task_name=getattr(reduce_task, "task_name", reduce_task))
+
         return wrapper
     if function:
         return actual_decorator(function)
@@ -0,0 +1,121 @@
+"""
+Helpers for low-overhead logging of task payloads.
+
+Task kwargs and results can be arbitrarily large, so they are never formatted eagerly:
+wrap them in LazyRepr and pass as logging arguments, so the string is only built
+(and truncated) if the record is actually emitted.
+"""
+import logging
+import random
+import reprlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_LEVEL = logging.INFO
+DEFAULT_LOG_SAMPLE_RATE = 1.0
+DEFAULT_LOG_MAX_LENGTH = 1024
+
+# invalid log levels that were already reported, so the warning is not repeated for every message
+_warned_log_levels = set()
+
+
+def parse_log_level(level):
+    """
+    :param level: log level as a number or a level name, e.g. "DEBUG".
+    :return: numeric log level
+    :raises ImproperlyConfigured: if the level is not valid
+    """
+    if isinstance(level, str):
+        numeric_level = logging.getLevelName(level.upper())
+        if isinstance(numeric_level, int):
+            return numeric_level
+    elif isinstance(level, int):
+        return level
+
+    raise ImproperlyConfigured(f"Unknown log level {level!r}, use a number or a level name, e.g. \"DEBUG\"")
+
+
+def get_log_level(task_log_level=None):
+    """
+    :param task_log_level: log level set for the task via @task decorator, if any.
+    Can be either a number or a level name, e.g. "DEBUG".
+    :return: numeric log level used for routine per-message task records.
+    Invalid levels fall back to DEFAULT_LOG_LEVEL, so a typo in logging settings never stops task processing.
+    """
+    level = task_log_level
+    if level is None:
+        level = getattr(settings, "AWS_EB_LOG_LEVEL", DEFAULT_LOG_LEVEL)
+
+    try:
+        return parse_log_level(level)
+    except ImproperlyConfigured as e:
+        warning_key = repr(level)
+        if warning_key not in _warned_log_levels:
+            _warned_log_levels.add(warning_key)
+            logger.warning(f"{e}. Falling back to {logging.getLevelName(DEFAULT_LOG_LEVEL)}")
+        return DEFAULT_LOG_LEVEL
+
+
+def get_sample_rate(task_sample_rate=None):
+    """
+    :param task_sample_rate: sample rate set for the task via @task decorator, if any.
+    :return: fraction of messages (0.0 - 1.0) that get routine log records.
+    """
+    if task_sample_rate is not None:
+        return task_sample_rate
+    return getattr(settings, "AWS_EB_LOG_SAMPLE_RATE", DEFAULT_LOG_SAMPLE_RATE)
+
+
+def is_sampled(sample_rate):
+    """
+    :return: True if the current message should be logged given the sample rate.
+    """
+    if sample_rate >= 1:
+        return True
+    if sample_rate <= 0:
+        return False
+    return random.random() < sample_rate
+
+
+def get_max_length():
+    """
+    :return: maximum length of logged kwargs and results, 0 or None disables truncation.
+    """
+    return getattr(settings, "AWS_EB_LOG_MAX_LENGTH", DEFAULT_LOG_MAX_LENGTH)
+
+
+class LazyRepr:
+    """
+    Defers repr() of a potentially large object until the log record is emitted.
+    The representation is built with reprlib, so huge containers are not walked in full,
+    and is then truncated to settings.AWS_EB_LOG_MAX_LENGTH characters.
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        max_length = get_max_length()
+
+        if not max_length:
+            return repr(self.obj)
+
+        repr_instance = reprlib.Repr()
+        repr_instance.maxlevel = 4
+        repr_instance.maxdict = repr_instance.maxlist = repr_instance.maxtuple = 64
+        repr_instance.maxset = repr_instance.maxfrozenset = repr_instance.maxdeque = 64
+        repr_instance.maxstring = repr_instance.maxother = max_length
+        repr_instance.maxlong = max_length
+
+        result = repr_instance.repr(self.obj)
+        if len(result) > max_length:
+            result = f"{result[:max_length]}...(truncated)"
+
+        return result
+
+    __repr__ = __str__
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from eb_sqs_worker import worker
+from eb_sqs_worker.consumer import WeightedQueuePoller
+from eb_sqs_worker.sqs import SQS_MAX_BATCH_ENTRIES
+
+
+class Command(BaseCommand):
+    help = "Polls queues from settings.AWS_EB_PRIORITY_QUEUES with weighted fairness and runs received tasks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("priorities", nargs="*",
+                            help="Priorities to poll, defaults to all priorities in settings.AWS_EB_PRIORITY_QUEUES")
+        parser.add_argument("--max-messages", type=int, default=10,
+                            help="Maximum number of messages received from a queue in one turn (1-10)")
+        parser.add_argument("--wait-time", type=int, default=5,
+                            help="Long polling time in seconds used when all queues are empty")
+
+    def handle(self, *args, **options):
+        if not getattr(settings, "AWS_EB_HANDLE_SQS_TASKS", False):
+            # same rule as for the sqsd endpoint: only worker environments run tasks
+            raise CommandError("settings.AWS_EB_HANDLE_SQS_TASKS must be True to process tasks")
+
+        if not 1 <= options["max_messages"] <= SQS_MAX_BATCH_ENTRIES:
+            raise CommandError(f"--max-messages must be between 1 and {SQS_MAX_BATCH_ENTRIES}")
+
+        poller = WeightedQueuePoller(priorities=options["priorities"] or None,
+                                     max_messages=options["max_messages"],
+                                     wait_time_seconds=options["wait_time"])
+
+        self.stdout.write(f"Polling priority queues {poller.weights}")
+
+        try:
+            poller.run()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped")
+        finally:
+            # release clients cached by tasks, e.g. to close connections cleanly
+            worker.close_resources()
@@ -1,3 +1,4 @@
+import itertools
 import json
 import uuid
 
@@ -7,8 +8,15 @@ from django.core.exceptions import ImproperlyConfigured
 from django.utils.module_loading import import_string
 import logging
 
+from eb_sqs_worker import log
 
 logger = logging.getLogger(__name__)
+
+# limits of SQS SendMessageBatch, see
+# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_SendMessageBatch.html
+SQS_MAX_BATCH_ENTRIES = 10
+SQS_MAX_BATCH_SIZE_BYTES = 256 * 1024
+
 try:
     AWS_REGION = settings.AWS_EB_DEFAULT_REGION
 except AttributeError:
@@ -21,7 +29,7 @@ sqs = boto3.resource('sqs',
                      aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
 
 
-def send_task(task_name, task_kwargs, run_locally=None, queue_name=None):
+def send_task(task_name, task_kwargs, run_locally=None, queue_name=None, priority=None):
     """
     Sends task to SQS queue to be run asynchronously on worker environment instances.
     If settings.AWS_EB_RUN_TASKS_LOCALLY  is set to True, does not send the task
@@ -32,6 +40,9 @@ def send_task(task_name, task_kwargs, run_locally=None, queue_name=None):
     :param task_kwargs kwargs that are passed to the task
     :param run_locally if set, forces the task to be run locally or sent to SQS
     regardless of what settings.AWS_EB_RUN_TASKS_LOCALLY is set to.
+    :param queue_name if set, the task is sent to this queue instead of the default one.
+    :param priority if set, the task is sent to the queue configured for this priority
+    in settings.AWS_EB_PRIORITY_QUEUES. Ignored if queue_name is set.
     :return:
     """
 
@@ -48,36 +59,174 @@ def send_task(task_name, task_kwargs, run_locally=None, queue_name=None):
         task_id = uuid.uuid4().hex
 
         task = SQSTask(task_data)
-        print(f"[{task_id}] Running task locally in sync mode: {task.get_pretty_info_string()}")
+        log_level, sample_rate = task.get_log_options()
+        log_enabled = logger.isEnabledFor(log_level) and log.is_sampled(sample_rate)
+
+        if log_enabled:
+            logger.log(log_level, "[%s] Running task locally in sync mode: %s", task_id, task)
 
         result = task.run_task()
-        print(f"[{task_id}] Task result: {result}")
 
-    else:
+        if log_enabled:
+            logger.log(log_level, "[%s] Task result: %s", task_id, log.LazyRepr(result))
 
-        if queue_name is None:
-            try:
-                queue_name = settings.AWS_EB_DEFAULT_QUEUE_NAME
-            except AttributeError:
-                raise ImproperlyConfigured("settings.AWS_EB_DEFAULT_QUEUE_NAME must be set to send task to SQS queue")
+    else:
 
-            # TODO: cache queues instead of looking the up every time
-        try:
-            # Get the queue. This returns an SQS.Queue instance
-            queue = sqs.get_queue_by_name(QueueName=queue_name)
-        except:
-            queue = sqs.create_queue(QueueName=queue_name)
+        queue_name = get_queue_name(queue_name=queue_name, priority=priority)
+        queue = get_queue(queue_name)
 
+        # resolved before sending, so nothing after a successful send can make the caller retry it
+        log_level, sample_rate = SQSTask(task_data).get_log_options()
 
         # send task to sqs workers
         # see https://boto3.amazonaws.com/v1/documentation/api/latest/guide/sqs.html
         response = queue.send_message(MessageBody=json.dumps(task_data))
-        logger.info(f"Sent message {task_data} to SQS queue {queue_name}. Got response: {response}")
+
+        if logger.isEnabledFor(log_level) and log.is_sampled(sample_rate):
+            logger.log(log_level, "Sent task %s to SQS queue %s. Got message id: %s",
+                       log.LazyRepr(task_data), queue_name, response.get('MessageId'))
 
         # print(response.get('MessageId'))
         # print(response.get('MD5OfMessageBody'))
 
 
+def send_task_chunks(task_name, kwargs_iterable, chunk_size, run_locally=None, queue_name=None, priority=None,
+                     reduce_task_name=None):
+    """
+    Splits kwargs_iterable into chunks of chunk_size items and sends each chunk as one task message.
+    On the worker the task is called once for every kwargs dictionary in the chunk.
+    If any call fails, the whole chunk message is redelivered and calls that already succeeded
+    run again, so the task (and the reduce task) must be idempotent.
+
+    The iterable is consumed lazily (e.g. queryset.iterator() or a generator), so only the chunks of
+    the current SQS batch are kept in memory. Chunks are sent with SendMessageBatch, up to
+    10 messages per request.
+
+    :param task_name name of the task to run.
+    :param kwargs_iterable iterable of kwargs dictionaries, one per task call
+    :param chunk_size number of task calls per message
+    :param run_locally if set, forces the chunks to be run locally or sent to SQS
+    regardless of what settings.AWS_EB_RUN_TASKS_LOCALLY is set to.
+    :param queue_name if set, chunks are sent to this queue instead of the default one.
+    :param priority if set, chunks are sent to the queue configured for this priority
+    in settings.AWS_EB_PRIORITY_QUEUES. Ignored if queue_name is set.
+    :param reduce_task_name if set, after a chunk is run its list of results is sent to this task
+    as "results" kwarg, so results must be json-serializable. The reduce task runs once per chunk,
+    not once for the whole iterable, and may receive the same chunk more than once if it is redelivered.
+    :return: number of chunks sent
+    """
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+
+    if run_locally is None:
+        run_locally = getattr(settings, "AWS_EB_RUN_TASKS_LOCALLY", False)
+
+    iterator = iter(kwargs_iterable)
+    chunks = iter(lambda: list(itertools.islice(iterator, chunk_size)), [])
+
+    chunks_count = 0
+
+    if run_locally:
+        for chunk in chunks:
+            SQSTask(_get_chunk_task_data(task_name, chunk, reduce_task_name)).run_task()
+            chunks_count += 1
+        return chunks_count
+
+    queue_name = get_queue_name(queue_name=queue_name, priority=priority)
+    queue = get_queue(queue_name)
+
+    entries = []
+    entries_size = 0
+
+    for chunk in chunks:
+        body = json.dumps(_get_chunk_task_data(task_name, chunk, reduce_task_name))
+        body_size = len(body.encode())
+
+        if body_size > SQS_MAX_BATCH_SIZE_BYTES:
+            raise ValueError(f"Chunk of task {task_name} is {body_size} bytes which exceeds SQS message size limit, "
+                             f"use smaller chunk_size")
+
+        if entries and (len(entries) >= SQS_MAX_BATCH_ENTRIES or entries_size + body_size > SQS_MAX_BATCH_SIZE_BYTES):
+            _send_message_batch(queue, entries)
+            entries = []
+            entries_size = 0
+
+        entries.append({'Id': str(chunks_count), 'MessageBody': body})
+        entries_size += body_size
+        chunks_count += 1
+
+    if entries:
+        _send_message_batch(queue, entries)
+
+    log_level, sample_rate = SQSTask({'task': task_name}).get_log_options()
+    if logger.isEnabledFor(log_level) and log.is_sampled(sample_rate):
+        logger.log(log_level, "Sent %s chunks of task %s to SQS queue %s", chunks_count, task_name, queue_name)
+
+    return chunks_count
+
+
+def _get_chunk_task_data(task_name, chunk, reduce_task_name=None):
+    task_data = {
+        'task': task_name,
+        'chunk': chunk,
+    }
+    if reduce_task_name:
+        task_data['reduce'] = reduce_task_name
+    return task_data
+
+
+def _send_message_batch(queue, entries, retries=2):
+    """
+    Sends entries with SendMessageBatch, retrying entries that failed.
+    """
+    response = queue.send_messages(Entries=entries)
+    failed = response.get('Failed') or []
+
+    if failed:
+        failed_ids = {failure['Id'] for failure in failed}
+        failed_entries = [entry for entry in entries if entry['Id'] in failed_ids]
+
+        if not retries:
+            raise RuntimeError(f"Failed to send {len(failed_entries)} messages to SQS queue {queue.url}: {failed}")
+
+        logger.warning("Retrying %s failed messages of SQS batch: %s", len(failed_entries), failed)
+        _send_message_batch(queue, failed_entries, retries=retries - 1)
+
+
+def get_queue_name(queue_name=None, priority=None):
+    """
+    Resolves the name of the queue to send task to.
+    Explicit queue name wins, then the queue of the priority, then settings.AWS_EB_DEFAULT_QUEUE_NAME.
+    :return:
+    """
+    if queue_name is not None:
+        return queue_name
+
+    if priority is not None:
+        priority_queues = getattr(settings, "AWS_EB_PRIORITY_QUEUES", None) or {}
+        try:
+            return priority_queues[priority]
+        except KeyError:
+            raise ImproperlyConfigured(f"Priority {priority} is not defined in settings.AWS_EB_PRIORITY_QUEUES")
+
+    try:
+        return settings.AWS_EB_DEFAULT_QUEUE_NAME
+    except AttributeError:
+        raise ImproperlyConfigured("settings.AWS_EB_DEFAULT_QUEUE_NAME must be set to send task to SQS queue")
+
+
+def get_queue(queue_name):
+    """
+    :return: SQS.Queue instance with the given name. Queues that don't exist are created.
+    """
+    # TODO: cache queues instead of looking the up every time
+    try:
+        # Get the queue. This returns an SQS.Queue instance
+        return sqs.get_queue_by_name(QueueName=queue_name)
+    except:
+        return sqs.create_queue(QueueName=queue_name)
+
+
 class SQSTask:
 
     def __init__(self, data, request=None):
@@ -94,12 +243,19 @@ class SQSTask:
                 "anotherArgument": [1,"a", 3,4]
             }
         }
+
+        Tasks sent with send_task_chunks have "chunk" instead of "arguments":
+        a list of kwargs dictionaries, the task function is called once for each of them.
+        They may also have "reduce" - name of the task that receives the list of results.
         """
 
         self.data = data
         self.task_name = data.get('task')
         self.task_kwargs = data.get('arguments', {})    # task may have no args
+        self.task_chunk = data.get('chunk')
+        self.reduce_task_name = data.get('reduce')
         self.last_result = None
+        self._task_object = None
         self.scheduled_time = None
         self.sender_id = None
 
@@ -137,19 +293,7 @@ class SQSTask:
         }
         :return:
         """
-        if not getattr(settings, "AWS_EB_ENABLED_TASKS", None):
-            raise ImproperlyConfigured(f"settings.AWS_EB_ENABLED_TASKS not set, cannot run task {self.task_name}")
-
-        if not isinstance(settings.AWS_EB_ENABLED_TASKS, dict):
-            raise ImproperlyConfigured(f"settings.AWS_EB_ENABLED_TASKS must be a dict, "
-                                       f"not {type(settings.AWS_EB_ENABLED_TASKS)}")
-
-        try:
-            task_method_path = settings.AWS_EB_ENABLED_TASKS[self.task_name]
-        except KeyError:
-            raise ImproperlyConfigured(f"Task named {self.task_name} is not defined in settings.AWS_EB_ENABLED_TASKS")
-
-        task_method = import_string(task_method_path)
+        task_method = self.get_task_object()
 
         # check for method added by @task decorator. If present, use it instead
         if hasattr(task_method, "execute"):
@@ -161,13 +305,88 @@ class SQSTask:
                                        f"Object for task f{self.task_name} is not callable, "
                                        f"it's a {type(task_method)}'")
 
-        result = task_method(**self.task_kwargs)
+        if self.task_chunk is not None:
+            result = [task_method(**kwargs) for kwargs in self.task_chunk]
+
+            if self.reduce_task_name and self._is_serializable(result):
+                # route the reduce task the way its @task decorator does
+                reduce_task = SQSTask({'task': self.reduce_task_name})
+                send_task(self.reduce_task_name, {"results": result},
+                          run_locally=reduce_task.get_task_option("run_locally"),
+                          queue_name=reduce_task.get_task_option("queue_name"),
+                          priority=reduce_task.get_task_option("priority"))
+        else:
+            result = task_method(**self.task_kwargs)
+
         self.last_result = result
 
         # TODO: make sure that the returned result is serialized and can be displayed in json correctly
 
         return result
 
+    def _is_serializable(self, results):
+        """
+        Checks that chunk results can be sent to the reduce task. Calls of the chunk have already run,
+        so a failure here must not fail the chunk, otherwise it would be redelivered forever.
+        """
+        try:
+            json.dumps({"results": results})
+        except (TypeError, ValueError) as e:
+            logger.error(f"Results of a chunk of task {self.task_name} are not json-serializable, "
+                         f"skipping reduce task {self.reduce_task_name}: {e}", exc_info=True)
+            return False
+
+        return True
+
+    def get_task_object(self):
+        """
+        Looks up the object associated with task_name in settings.AWS_EB_ENABLED_TASKS.
+        For tasks registered via @task decorator this is the decorated function
+        that also carries the options passed to the decorator.
+        The object is looked up once and cached, as its options are read several times per message.
+        :return:
+        """
+        if self._task_object is not None:
+            return self._task_object
+
+        if not getattr(settings, "AWS_EB_ENABLED_TASKS", None):
+            raise ImproperlyConfigured(f"settings.AWS_EB_ENABLED_TASKS not set, cannot run task {self.task_name}")
+
+        if not isinstance(settings.AWS_EB_ENABLED_TASKS, dict):
+            raise ImproperlyConfigured(f"settings.AWS_EB_ENABLED_TASKS must be a dict, "
+                                       f"not {type(settings.AWS_EB_ENABLED_TASKS)}")
+
+        try:
+            task_method_path = settings.AWS_EB_ENABLED_TASKS[self.task_name]
+        except KeyError:
+            raise ImproperlyConfigured(f"Task named {self.task_name} is not defined in settings.AWS_EB_ENABLED_TASKS")
+
+        self._task_object = import_string(task_method_path)
+
+        return self._task_object
+
+    def get_task_option(self, name, default=None):
+        """
+        :return: value of the option passed to @task decorator of this task, or default
+        if the task was not registered through decorator or can't be found.
+        """
+        try:
+            task_object = self.get_task_object()
+        except (ImproperlyConfigured, ImportError):
+            # unknown tasks still fail loudly in run_task, here we just fall back to defaults
+            return default
+
+        value = getattr(task_object, name, None)
+        return default if value is None else value
+
+    def get_log_options(self):
+        """
+        :return: tuple of (log level, sample rate) to use for routine log records of this task.
+        Values passed to @task decorator take precedence over settings.
+        """
+        return (log.get_log_level(self.get_task_option("log_level")),
+                log.get_sample_rate(self.get_task_option("log_sample_rate")))
+
     def get_pretty_info_string(self):
         periodic_marker = ""
         periodic_info = ""
@@ -175,6 +394,14 @@ class SQSTask:
             periodic_marker = "Periodic "
             periodic_info = f", scheduled at {self.scheduled_time} by {self.sender_id}"
 
-        result = f"{periodic_marker}Task({self.task_name}, kwargs: {self.task_kwargs}{periodic_info})"
+        if self.task_chunk is not None:
+            arguments_info = f"chunk of {len(self.task_chunk)}: {log.LazyRepr(self.task_chunk)}"
+        else:
+            arguments_info = f"kwargs: {log.LazyRepr(self.task_kwargs)}"
+
+        result = f"{periodic_marker}Task({self.task_name}, {arguments_info}{periodic_info})"
 
         return result
+
+    def __str__(self):
+        return self.get_pretty_info_string()
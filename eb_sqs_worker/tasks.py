@@ -10,6 +10,14 @@ def test_task(**kwargs):
 
     return kwargs
 
+def test_failing_task(**kwargs):
+    """
+    Test task, always fails.
+    """
+
+    raise RuntimeError("The failing test task failed as expected")
+
+
 @task
 def decorated_test_task(**kwargs):
     """
@@ -31,3 +39,44 @@ def decorated_test_task_with_decorator_args(**kwargs):
     print(f"The decorated (with args) test task is being run with kwargs {kwargs} and will echo them back")
 
     return kwargs
+
+@task(log_level="DEBUG", log_sample_rate=0)
+def decorated_test_task_with_log_options(**kwargs):
+    """
+    Test task, echos back all arguments that it receives.
+    This one has custom logging options set in decorator
+    """
+
+    return kwargs
+
+
+def test_unserializable_result_task(**kwargs):
+    """
+    Test task, returns a result that can't be serialized to json.
+    """
+
+    return object()
+
+
+# collects results passed to decorated_test_reduce_task so tests can check them
+reduced_results = []
+
+
+@task
+def decorated_test_reduce_task(results):
+    """
+    Test reduce task, collects results of chunks.
+    """
+
+    reduced_results.append(results)
+
+    return len(results)
+
+
+@task(priority="high")
+def decorated_test_priority_reduce_task(results):
+    """
+    Test reduce task that is routed to a priority queue.
+    """
+
+    return len(results)
@@ -1,4 +1,7 @@
+import io
 import json
+import time
+import uuid
 
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase, Client, RequestFactory
@@ -147,3 +150,654 @@ class SQSLocalDecoratedTasksTestCase(TestCase):
                 from eb_sqs_worker import tasks
                 reload(tasks)
                 reload(tasks)
+
+
+class SQSTaskLoggingTestCase(TestCase):
+
+    def test_lazy_repr_truncates_large_payloads(self):
+        from eb_sqs_worker.log import LazyRepr
+
+        with self.settings(AWS_EB_LOG_MAX_LENGTH=50):
+            result = str(LazyRepr({"foo": "x" * 10000}))
+            self.assertLessEqual(len(result), 50 + len("...(truncated)"))
+            self.assertTrue(result.endswith("...(truncated)"))
+
+        with self.settings(AWS_EB_LOG_MAX_LENGTH=None):
+            self.assertEqual(str(LazyRepr({"foo": "x" * 10000})), repr({"foo": "x" * 10000}))
+
+    def test_handled_task_is_logged(self):
+        with self.settings(
+                AWS_EB_HANDLE_SQS_TASKS=True,  # must be True ONLY on isolated worker environments
+                AWS_EB_RUN_TASKS_LOCALLY=False,  # set to False to send tasks to SQS
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task"
+                }
+        ):
+            sqs_client = Client(HTTP_USER_AGENT="aws-sqsd/1.1")
+            with self.assertLogs("eb_sqs_worker.views", level="INFO") as logs:
+                response = sqs_client.post(reverse("sqs_handle"),
+                                           json.dumps({
+                                               "task": "echo_task",
+                                               "arguments": {"foo": "bar"}
+                                           }), content_type="application/json")
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(any("Received Task(echo_task" in line for line in logs.output))
+            self.assertTrue(any("Finished Task(echo_task" in line for line in logs.output))
+
+    def test_sampled_out_task_is_not_logged(self):
+        with self.settings(
+                AWS_EB_HANDLE_SQS_TASKS=True,  # must be True ONLY on isolated worker environments
+                AWS_EB_RUN_TASKS_LOCALLY=False,  # set to False to send tasks to SQS
+                AWS_EB_ALERT_WHEN_EXECUTES_LONGER_THAN_SECONDS=None,
+                AWS_EB_LOG_SAMPLE_RATE=0,
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task"
+                }
+        ):
+            import logging
+            sqs_client = Client(HTTP_USER_AGENT="aws-sqsd/1.1")
+            with self.assertLogs("eb_sqs_worker.views", level="DEBUG") as logs:
+                # assertLogs fails if nothing is logged at all
+                logging.getLogger("eb_sqs_worker.views").debug("marker")
+                response = sqs_client.post(reverse("sqs_handle"),
+                                           json.dumps({
+                                               "task": "echo_task",
+                                               "arguments": {"foo": "bar"}
+                                           }), content_type="application/json")
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(logs.output), 1)
+
+    def test_decorator_log_options(self):
+        from eb_sqs_worker.sqs import SQSTask
+        import logging
+
+        with self.settings(
+                AWS_EB_ENABLED_TASKS={
+                    "log_options_task": "eb_sqs_worker.tasks.decorated_test_task_with_log_options",
+                    "echo_task": "eb_sqs_worker.tasks.decorated_test_task",
+                }
+        ):
+            task = SQSTask({"task": "log_options_task"})
+            self.assertEqual(task.get_log_options(), (logging.DEBUG, 0))
+
+            # tasks without decorator options fall back to settings
+            with self.settings(AWS_EB_LOG_LEVEL="WARNING", AWS_EB_LOG_SAMPLE_RATE=0.5):
+                task = SQSTask({"task": "echo_task"})
+                self.assertEqual(task.get_log_options(), (logging.WARNING, 0.5))
+
+
+    def test_invalid_log_level_falls_back_to_default(self):
+        import logging
+        from eb_sqs_worker import log
+
+        log._warned_log_levels.clear()
+
+        with self.settings(
+                AWS_EB_HANDLE_SQS_TASKS=True,  # must be True ONLY on isolated worker environments
+                AWS_EB_LOG_LEVEL="VERBOSE",
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task"
+                }
+        ):
+            sqs_client = Client(HTTP_USER_AGENT="aws-sqsd/1.1")
+            with self.assertLogs("eb_sqs_worker.log", level="WARNING") as logs:
+                for _ in range(2):
+                    response = sqs_client.post(reverse("sqs_handle"),
+                                               json.dumps({
+                                                   "task": "echo_task",
+                                                   "arguments": {"foo": "bar"}
+                                               }), content_type="application/json")
+                    self.assertEqual(response.status_code, 200)
+
+            # warned only once
+            self.assertEqual(len(logs.output), 1)
+            self.assertEqual(log.get_log_level(), logging.INFO)
+
+    def test_invalid_decorator_log_level_is_rejected(self):
+        from eb_sqs_worker.decorators import task
+
+        with self.assertRaises(ImproperlyConfigured):
+            @task(task_name="invalid_log_level_task", log_level="VERBOSE")
+            def invalid_log_level_task(**kwargs):
+                return kwargs
+
+    def test_task_object_is_looked_up_once(self):
+        from unittest import mock
+        from eb_sqs_worker import sqs
+
+        with self.settings(
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task"
+                }
+        ):
+            task = sqs.SQSTask({"task": "echo_task", "arguments": {"foo": "bar"}})
+
+            with mock.patch.object(sqs, "import_string", wraps=sqs.import_string) as import_string:
+                task.get_log_options()
+                task.get_task_option("max_concurrency")
+                self.assertEqual(task.run_task(), {"foo": "bar"})
+
+            self.assertEqual(import_string.call_count, 1)
+
+class FakeMessage:
+
+    def __init__(self, body):
+        self.body = body
+        self.message_id = uuid.uuid4().hex
+        self.receipt_handle = uuid.uuid4().hex
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeQueue:
+
+    def __init__(self, messages=None):
+        self.messages = list(messages or [])
+        self.attributes = {"VisibilityTimeout": "30"}
+        self.visibility_changes = []
+
+    def change_message_visibility_batch(self, Entries):
+        self.visibility_changes.append([entry["ReceiptHandle"] for entry in Entries])
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def send_message(self, MessageBody):
+        message = FakeMessage(MessageBody)
+        self.messages.append(message)
+        return {"MessageId": message.message_id}
+
+    def send_messages(self, Entries):
+        self.messages.extend(FakeMessage(entry["MessageBody"]) for entry in Entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in Entries]}
+
+    def receive_messages(self, MaxNumberOfMessages=10, WaitTimeSeconds=0):
+        received = self.messages[:MaxNumberOfMessages]
+        self.messages = self.messages[MaxNumberOfMessages:]
+        return received
+
+
+class SQSPriorityQueuesTestCase(TestCase):
+
+    def test_priority_routes_to_priority_queue(self):
+        from eb_sqs_worker import sqs
+
+        with self.settings(
+                AWS_EB_DEFAULT_QUEUE_NAME="default",
+                AWS_EB_PRIORITY_QUEUES={"high": "interactive", "low": "backfill"}
+        ):
+            self.assertEqual(sqs.get_queue_name(), "default")
+            self.assertEqual(sqs.get_queue_name(priority="high"), "interactive")
+            # explicit queue name wins
+            self.assertEqual(sqs.get_queue_name(queue_name="important", priority="high"), "important")
+
+            with self.assertRaises(ImproperlyConfigured):
+                sqs.get_queue_name(priority="urgent")
+
+    def test_weighted_polling(self):
+        from eb_sqs_worker.consumer import WeightedQueuePoller
+
+        with self.settings(
+                AWS_EB_PRIORITY_QUEUES={"high": "interactive", "low": "backfill"},
+                AWS_EB_PRIORITY_WEIGHTS={"high": 3}
+        ):
+            poller = WeightedQueuePoller(queues={"high": FakeQueue(), "low": FakeQueue()})
+            order = [poller.next_priority() for _ in range(8)]
+
+            self.assertEqual(order.count("high"), 6)
+            self.assertEqual(order.count("low"), 2)
+
+    def test_poller_runs_tasks_and_deletes_messages(self):
+        from eb_sqs_worker.consumer import WeightedQueuePoller
+
+        with self.settings(
+                AWS_EB_PRIORITY_QUEUES={"high": "interactive", "low": "backfill"},
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task"
+                }
+        ):
+            good_message = FakeMessage(json.dumps({"task": "echo_task", "arguments": {"foo": "bar"}}))
+            bad_message = FakeMessage(json.dumps({"task": "unknown_task"}))
+
+            poller = WeightedQueuePoller(max_messages=1,
+                                         queues={"high": FakeQueue(), "low": FakeQueue([good_message, bad_message])})
+
+            # empty high priority queue is skipped
+            self.assertEqual(poller.poll_once(), 1)
+            self.assertTrue(good_message.deleted)
+
+            with self.assertLogs("eb_sqs_worker.consumer", level="ERROR"):
+                self.assertEqual(poller.poll_once(), 1)
+            # failed task is left in the queue for redelivery
+            self.assertFalse(bad_message.deleted)
+
+
+    def test_high_priority_message_runs_during_low_priority_batch(self):
+        from eb_sqs_worker.consumer import WeightedQueuePoller
+
+        with self.settings(
+                AWS_EB_PRIORITY_QUEUES={"high": "interactive", "low": "backfill"},
+                AWS_EB_PRIORITY_WEIGHTS={"high": 3},
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task"
+                }
+        ):
+            low_messages = [FakeMessage(json.dumps({"task": "echo_task", "arguments": {"low": i}}))
+                            for i in range(3)]
+            high_message = FakeMessage(json.dumps({"task": "echo_task", "arguments": {"high": 0}}))
+
+            high_queue = FakeQueue()
+            low_queue = FakeQueue(low_messages)
+            poller = WeightedQueuePoller(queues={"high": high_queue, "low": low_queue})
+
+            processed = []
+            process_message = poller.process_message
+
+            def record_process_message(priority, message):
+                processed.append(message)
+                process_message(priority, message)
+                # high priority message arrives while the low priority batch is being processed
+                if message is low_messages[0]:
+                    high_queue.messages.append(high_message)
+
+            poller.process_message = record_process_message
+
+            self.assertEqual(poller.poll_once(), 4)
+            self.assertEqual(processed, [low_messages[0], high_message, low_messages[1], low_messages[2]])
+            self.assertTrue(all(message.deleted for message in processed))
+
+            # visibility of messages waiting in the batch is extended before every task
+            receipt_handles = [message.receipt_handle for message in low_messages]
+            # the message about to run is extended too
+            self.assertEqual(low_queue.visibility_changes,
+                             [receipt_handles, receipt_handles[1:], receipt_handles[1:], receipt_handles[2:]])
+            self.assertEqual(high_queue.visibility_changes, [[high_message.receipt_handle]])
+
+            with self.assertRaises(ValueError):
+                WeightedQueuePoller(max_messages=11, queues={"high": FakeQueue(), "low": FakeQueue()})
+
+
+    def test_command_rejects_invalid_max_messages(self):
+        from django.core.management import call_command, CommandError
+
+        with self.settings(AWS_EB_HANDLE_SQS_TASKS=True):
+            with self.assertRaises(CommandError):
+                call_command("process_priority_queues", "--max-messages", "11")
+
+
+class SQSTaskChunksTestCase(TestCase):
+
+    def test_local_chunks_with_reduce(self):
+        with self.settings(
+                AWS_EB_RUN_TASKS_LOCALLY=True,  # set to False to send tasks to SQS
+                AWS_EB_ENABLED_TASKS={
+                    "eb_sqs_worker.tasks.decorated_test_task": "eb_sqs_worker.tasks.decorated_test_task",
+                    "eb_sqs_worker.tasks.decorated_test_reduce_task": "eb_sqs_worker.tasks.decorated_test_reduce_task",
+                }
+        ):
+            from eb_sqs_worker import tasks
+
+            del tasks.reduced_results[:]
+
+            chunks_count = tasks.decorated_test_task.chunks(({"number": i} for i in range(5)), 2,
+                                                            reduce_task=tasks.decorated_test_reduce_task)
+
+            self.assertEqual(chunks_count, 3)
+            self.assertEqual(tasks.reduced_results, [
+                [{"number": 0}, {"number": 1}],
+                [{"number": 2}, {"number": 3}],
+                [{"number": 4}],
+            ])
+
+    def test_chunks_are_sent_in_batches(self):
+        from unittest import mock
+        from eb_sqs_worker import sqs
+
+        with self.settings(
+                AWS_EB_RUN_TASKS_LOCALLY=False,  # set to False to send tasks to SQS
+                AWS_EB_DEFAULT_QUEUE_NAME="default",
+        ):
+            queue = FakeQueue()
+            with mock.patch.object(sqs, "get_queue", return_value=queue), \
+                    mock.patch.object(queue, "send_messages", wraps=queue.send_messages) as send_messages:
+                chunks_count = sqs.send_task_chunks("echo_task", ({"number": i} for i in range(250)), 10)
+
+            self.assertEqual(chunks_count, 25)
+            # 25 chunks fit into 3 batches of up to 10 messages
+            self.assertEqual(send_messages.call_count, 3)
+            self.assertEqual(len(queue.messages), 25)
+
+            task = sqs.SQSTask(json.loads(queue.messages[-1].body))
+            self.assertEqual(task.task_chunk, [{"number": i} for i in range(240, 250)])
+
+
+    def test_reduce_task_is_routed_by_its_decorator(self):
+        from unittest import mock
+        from eb_sqs_worker import sqs
+
+        with self.settings(
+                AWS_EB_RUN_TASKS_LOCALLY=False,  # set to False to send tasks to SQS
+                AWS_EB_DEFAULT_QUEUE_NAME="default",
+                AWS_EB_PRIORITY_QUEUES={"high": "interactive"},
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task",
+                    "priority_reduce_task": "eb_sqs_worker.tasks.decorated_test_priority_reduce_task",
+                }
+        ):
+            queues = {}
+
+            def get_queue(queue_name):
+                return queues.setdefault(queue_name, FakeQueue())
+
+            task = sqs.SQSTask({"task": "echo_task", "chunk": [{"foo": "bar"}], "reduce": "priority_reduce_task"})
+
+            with mock.patch.object(sqs, "get_queue", side_effect=get_queue):
+                task.run_task()
+
+            self.assertEqual(list(queues.keys()), ["interactive"])
+            reduce_task = sqs.SQSTask(json.loads(queues["interactive"].messages[0].body))
+            self.assertEqual(reduce_task.task_name, "priority_reduce_task")
+            self.assertEqual(reduce_task.task_kwargs, {"results": [{"foo": "bar"}]})
+
+
+    def test_unserializable_results_skip_reduce(self):
+        from eb_sqs_worker import sqs
+        from eb_sqs_worker import tasks
+
+        with self.settings(
+                AWS_EB_RUN_TASKS_LOCALLY=True,  # set to False to send tasks to SQS
+                AWS_EB_ENABLED_TASKS={
+                    "unserializable_task": "eb_sqs_worker.tasks.test_unserializable_result_task",
+                    "reduce_task": "eb_sqs_worker.tasks.decorated_test_reduce_task",
+                }
+        ):
+            del tasks.reduced_results[:]
+
+            task = sqs.SQSTask({"task": "unserializable_task", "chunk": [{"foo": "bar"}], "reduce": "reduce_task"})
+
+            with self.assertLogs("eb_sqs_worker.sqs", level="ERROR"):
+                result = task.run_task()
+
+            # the chunk itself does not fail
+            self.assertEqual(len(result), 1)
+            self.assertEqual(tasks.reduced_results, [])
+
+
+class WorkerHooksTestCase(TestCase):
+
+    def test_hooks_are_called_around_handled_task(self):
+        from eb_sqs_worker import worker
+
+        calls = []
+
+        @worker.on_task_start
+        def task_start(task):
+            calls.append(("start", task.task_name))
+
+        @worker.on_task_end
+        def task_end(task, result, exception):
+            calls.append(("end", task.task_name, result, exception))
+
+        try:
+            with self.settings(
+                    AWS_EB_HANDLE_SQS_TASKS=True,  # must be True ONLY on isolated worker environments
+                    AWS_EB_ENABLED_TASKS={
+                        "echo_task": "eb_sqs_worker.tasks.test_task"
+                    }
+            ):
+                sqs_client = Client(HTTP_USER_AGENT="aws-sqsd/1.1")
+                response = sqs_client.post(reverse("sqs_handle"),
+                                           json.dumps({
+                                               "task": "echo_task",
+                                               "arguments": {"foo": "bar"}
+                                           }), content_type="application/json")
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(calls, [("start", "echo_task"), ("end", "echo_task", {"foo": "bar"}, None)])
+        finally:
+            worker._task_start_hooks.remove(task_start)
+            worker._task_end_hooks.remove(task_end)
+
+    def test_resource_is_reused_until_health_check_fails(self):
+        from eb_sqs_worker import worker
+        from eb_sqs_worker.sqs import SQSTask
+
+        created = []
+        closed = []
+
+        @worker.resource("test_client", health_check=lambda client: client["healthy"], close=closed.append)
+        def make_test_client():
+            client = {"healthy": True}
+            created.append(client)
+            return client
+
+        try:
+            task = SQSTask({"task": "echo_task"})
+
+            worker.task_started(task)
+            client = worker.get_resource("test_client")
+            self.assertIs(worker.get_resource("test_client"), client)
+
+            worker.task_started(task)
+            self.assertIs(worker.get_resource("test_client"), client)
+            self.assertEqual(len(created), 1)
+
+            client["healthy"] = False
+            # health check is done once per task
+            self.assertIs(worker.get_resource("test_client"), client)
+
+            worker.task_started(task)
+            new_client = worker.get_resource("test_client")
+            self.assertIsNot(new_client, client)
+            self.assertEqual(closed, [client])
+
+            with self.assertRaises(ImproperlyConfigured):
+                worker.get_resource("unknown_client")
+        finally:
+            worker.close_resources()
+            del worker._resource_factories["test_client"]
+
+
+    def test_worker_start_hooks_run_once_and_retry_after_failure(self):
+        from eb_sqs_worker import worker
+        from eb_sqs_worker.sqs import SQSTask
+
+        calls = []
+
+        @worker.on_worker_start
+        def worker_start():
+            calls.append("start")
+            if len(calls) == 1:
+                raise RuntimeError("worker start failed")
+
+        worker_started = worker._worker_started
+        worker._worker_started = False
+
+        try:
+            task = SQSTask({"task": "echo_task"})
+
+            with self.assertRaises(RuntimeError):
+                worker.task_started(task)
+            self.assertFalse(worker._worker_started)
+
+            # hooks are retried before the next task and then never run again
+            worker.task_started(task)
+            worker.task_started(task)
+            self.assertEqual(calls, ["start", "start"])
+            self.assertTrue(worker._worker_started)
+        finally:
+            worker._worker_start_hooks.remove(worker_start)
+            worker._worker_started = worker_started
+
+    def test_resources_are_closed_when_command_stops(self):
+        from unittest import mock
+        from django.core.management import call_command
+        from eb_sqs_worker import worker
+
+        closed = []
+
+        @worker.resource("command_test_client", close=closed.append)
+        def make_command_test_client():
+            return {"client": True}
+
+        try:
+            client = worker.get_resource("command_test_client")
+
+            with self.settings(AWS_EB_HANDLE_SQS_TASKS=True), \
+                    mock.patch("eb_sqs_worker.management.commands.process_priority_queues.WeightedQueuePoller") \
+                    as poller_class:
+                poller_class.return_value.run.side_effect = KeyboardInterrupt
+                call_command("process_priority_queues", stdout=io.StringIO())
+
+            self.assertEqual(closed, [client])
+        finally:
+            worker.close_resources()
+            del worker._resource_factories["command_test_client"]
+
+
+class SQSTaskAdmissionControlTestCase(TestCase):
+
+    def setUp(self):
+        from eb_sqs_worker import admission
+        admission.reset()
+
+    def tearDown(self):
+        from eb_sqs_worker import admission
+        admission.reset()
+
+    def post_task(self, task_name):
+        sqs_client = Client(HTTP_USER_AGENT="aws-sqsd/1.1")
+        return sqs_client.post(reverse("sqs_handle"),
+                               json.dumps({
+                                   "task": task_name,
+                                   "arguments": {"foo": "bar"}
+                               }), content_type="application/json")
+
+    def test_task_over_process_limit_is_rejected(self):
+        from eb_sqs_worker import admission
+
+        with self.settings(
+                AWS_EB_HANDLE_SQS_TASKS=True,  # must be True ONLY on isolated worker environments
+                AWS_EB_MAX_CONCURRENT_TASKS=1,
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task"
+                }
+        ):
+            # simulate another task running in this process
+            other_admission = admission.admit("other_task")
+            self.assertEqual(self.post_task("echo_task").status_code, 503)
+
+            admission.release(other_admission, success=True)
+            self.assertEqual(self.post_task("echo_task").status_code, 200)
+
+    def test_task_over_task_limit_is_rejected(self):
+        from eb_sqs_worker import admission
+
+        admission.admit("echo_task", max_task_concurrency=1)
+        # other tasks are not affected
+        admission.admit("other_task", max_task_concurrency=1)
+
+        with self.assertRaises(admission.TaskConcurrencyLimitExceeded) as context:
+            admission.admit("echo_task", max_task_concurrency=1)
+        self.assertEqual(context.exception.status_code, 429)
+
+    def test_circuit_breaker_sheds_failing_task(self):
+        from unittest import mock
+        from eb_sqs_worker import admission
+
+        with self.settings(
+                AWS_EB_HANDLE_SQS_TASKS=True,  # must be True ONLY on isolated worker environments
+                AWS_EB_CIRCUIT_BREAKER_FAILURE_THRESHOLD=2,
+                AWS_EB_CIRCUIT_BREAKER_RESET_SECONDS=60,
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task",
+                    "failing_task": "eb_sqs_worker.tasks.test_failing_task",
+                }
+        ):
+            for _ in range(2):
+                with self.assertRaises(RuntimeError):
+                    self.post_task("failing_task")
+
+            # breaker is open, the task is not run anymore
+            self.assertEqual(self.post_task("failing_task").status_code, 503)
+            # healthy tasks are not affected
+            self.assertEqual(self.post_task("echo_task").status_code, 200)
+
+            # after reset time one trial run is let through
+            with mock.patch("eb_sqs_worker.admission.time.monotonic", return_value=time.monotonic() + 61):
+                with self.assertRaises(RuntimeError):
+                    self.post_task("failing_task")
+                self.assertEqual(self.post_task("failing_task").status_code, 503)
+
+    def test_slot_is_released_when_failing_before_task_runs(self):
+        from unittest import mock
+        from eb_sqs_worker import admission
+
+        with self.settings(
+                AWS_EB_HANDLE_SQS_TASKS=True,  # must be True ONLY on isolated worker environments
+                AWS_EB_MAX_CONCURRENT_TASKS=1,
+                AWS_EB_CIRCUIT_BREAKER_FAILURE_THRESHOLD=1,
+                AWS_EB_ENABLED_TASKS={
+                    "echo_task": "eb_sqs_worker.tasks.test_task"
+                }
+        ):
+            # log options are resolved after the slot is taken, simulate a failure there
+            failing_log_options = mock.patch("eb_sqs_worker.sqs.SQSTask.get_log_options",
+                                             side_effect=RuntimeError("failure between admit and run"))
+
+            with failing_log_options:
+                with self.assertRaises(RuntimeError):
+                    self.post_task("echo_task")
+
+            self.assertEqual(admission._running_total, 0)
+
+            # the failure opened the breaker, after reset time the half-open trial fails before running the task
+            with mock.patch("eb_sqs_worker.admission.time.monotonic", return_value=time.monotonic() + 61):
+                with failing_log_options:
+                    with self.assertRaises(RuntimeError):
+                        self.post_task("echo_task")
+
+                self.assertFalse(admission._breakers["echo_task"].trial_running)
+
+            with mock.patch("eb_sqs_worker.admission.time.monotonic", return_value=time.monotonic() + 122):
+                self.assertEqual(self.post_task("echo_task").status_code, 200)
+                self.assertFalse(admission._breakers["echo_task"].is_open())
+
+            self.assertEqual(admission._running_total, 0)
+
+    def test_runs_admitted_before_breaker_opened_dont_decide_trial(self):
+        from unittest import mock
+        from eb_sqs_worker import admission
+
+        with self.settings(
+                AWS_EB_CIRCUIT_BREAKER_FAILURE_THRESHOLD=1,
+                AWS_EB_CIRCUIT_BREAKER_RESET_SECONDS=60,
+        ):
+            # two messages are in flight when the breaker opens
+            first = admission.admit("echo_task")
+            second = admission.admit("echo_task")
+            third = admission.admit("echo_task")
+            admission.release(first, success=False)
+
+            breaker = admission._breakers["echo_task"]
+            self.assertTrue(breaker.is_open())
+
+            with mock.patch("eb_sqs_worker.admission.time.monotonic", return_value=time.monotonic() + 61):
+                trial = admission.admit("echo_task")
+                self.assertTrue(trial.is_trial)
+
+                # late failure does not let a second trial through
+                admission.release(second, success=False)
+                with self.assertRaises(admission.CircuitOpen):
+                    admission.admit("echo_task")
+
+                # late success does not close the breaker while the trial is running
+                admission.release(third, success=True)
+                self.assertTrue(breaker.is_open())
+                self.assertTrue(breaker.trial_running)
+
+                admission.release(trial, success=True)
+                self.assertFalse(breaker.is_open())
+                self.assertEqual(admission._running_total, 0)
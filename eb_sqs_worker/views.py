@@ -13,8 +13,13 @@ from django.views import View
 from django.http import JsonResponse, Http404, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 
+from eb_sqs_worker import admission
+from eb_sqs_worker import log
+from eb_sqs_worker import worker
 from eb_sqs_worker.sqs import SQSTask
 
+logger = logging.getLogger(__name__)
+
 
 @method_decorator(csrf_exempt, name='dispatch')  # otherwise will hit csrf protection
 class HandleSQSTaskView(View):
@@ -57,33 +62,64 @@ class HandleSQSTaskView(View):
         # create task instance and try to run it
         task = SQSTask(body_json, request)
 
-        print(f"[{call_id}] Received {task.get_pretty_info_string()}. Headers: {request.headers if hasattr(request, 'headers') else request.META}")
-
-        start_time = time.time()
-
-        # run the task
-        result = task.run_task()
+        # shed the task before doing any work if the process is overloaded or the task keeps failing,
+        # sqsd will redeliver the message after visibility timeout
+        try:
+            task_admission = admission.admit(task.task_name, task.get_task_option("max_concurrency"))
+        except admission.TaskRejected as e:
+            logger.warning("[%s] Rejected task %s: %s", call_id, task.task_name, e)
+            return JsonResponse({}, status=e.status_code)
+
+        # the slot taken by admit() must be released whatever happens below,
+        # otherwise the process (or the half-open circuit breaker) stays blocked until restart
+        success = False
+        try:
+            # the sampling decision is made once per message, so received/finished records come in pairs
+            log_level, sample_rate = task.get_log_options()
+            log_enabled = logger.isEnabledFor(log_level) and log.is_sampled(sample_rate)
+
+            if log_enabled:
+                logger.log(log_level, "[%s] Received %s", call_id, task)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[%s] Headers: %s", call_id, log.LazyRepr(dict(request.headers)))
+
+            start_time = time.time()
+
+            # run the task
+            try:
+                worker.task_started(task)
+                result = task.run_task()
+            except Exception as e:
+                worker.task_finished(task, exception=e)
+                raise
+
+            success = True
+        finally:
+            admission.release(task_admission, success=success)
+
+        worker.task_finished(task, result=result)
 
         execution_time = time.time()-start_time
 
-        print(f"{call_id} Finished {task.get_pretty_info_string()}. "
-              f"Result: {result}. Execution time: {execution_time}s.")
+        if log_enabled:
+            logger.log(log_level, "[%s] Finished %s. Result: %s. Execution time: %ss.",
+                       call_id, task, log.LazyRepr(result), execution_time)
 
         alert_threshold_seconds = getattr(settings, "AWS_EB_ALERT_WHEN_EXECUTES_LONGER_THAN_SECONDS", None)
         if alert_threshold_seconds:
             if execution_time > alert_threshold_seconds:
                 try:
-                    print(f"{call_id} took to long too finish. Reporting to admins via email. ")
+                    logger.warning("[%s] took to long too finish. Reporting to admins via email.", call_id)
                     mail_admins(f"Task {task.task_name} was running for too long",
                             f"\nTask {task.get_pretty_info_string()} (call id {call_id}) finished in {execution_time}s "
                             f"and you have "
                             f"alert thresholds set to {alert_threshold_seconds}. \nPlease check if there is "
                             f"something wrong with the task execution."
-                            f"\nTask result: {result}",
+                            f"\nTask result: {log.LazyRepr(result)}",
                             fail_silently=False, connection=None, html_message=None)
                 except Exception as e:
 
-                    logging.error(f"Failed to send email about long-running task {call_id}: {e}", exc_info=True)
+                    logger.error(f"Failed to send email about long-running task {call_id}: {e}", exc_info=True)
 
         return JsonResponse(
             {},
@@ -0,0 +1,191 @@
+"""
+Worker lifecycle hooks and per-worker resource cache.
+
+Hooks and resources are registered with decorators, so the modules defining them must be imported
+when django loads, same as modules with tasks:
+
+    from eb_sqs_worker import worker
+
+    @worker.on_worker_start
+    def warm_up():
+        ...
+
+    @worker.resource("s3", health_check=lambda client: client.list_buckets() is not None)
+    def make_s3_client():
+        return boto3.client("s3")
+
+    @task
+    def upload(**kwargs):
+        s3 = worker.get_resource("s3")
+        ...
+
+Hooks are called by the worker entry points (sqsd endpoint and process_priority_queues command),
+not for tasks run locally in sync mode.
+"""
+import logging
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+_worker_start_hooks = []
+_task_start_hooks = []
+_task_end_hooks = []
+
+_worker_started = False
+_worker_start_lock = threading.Lock()
+
+# name -> (factory, health_check, close)
+_resource_factories = {}
+
+# resources are cached per thread, so clients that are not thread-safe can be cached as well
+_local = threading.local()
+
+
+def on_worker_start(f):
+    """
+    Registers function that is called once per worker process before the first task is run.
+    """
+    _worker_start_hooks.append(f)
+    return f
+
+
+def on_task_start(f):
+    """
+    Registers function that is called before every task with SQSTask instance as the only argument.
+    """
+    _task_start_hooks.append(f)
+    return f
+
+
+def on_task_end(f):
+    """
+    Registers function that is called after every task, even a failed one,
+    with SQSTask instance, task result and raised exception (or None) as arguments.
+    """
+    _task_end_hooks.append(f)
+    return f
+
+
+def resource(name, health_check=None, close=None):
+    """
+    Registers decorated function as a factory of a resource that tasks can request with get_resource(name).
+    The resource is created once per worker thread and reused between tasks.
+
+    :param name: name of the resource
+    :param health_check: optional callable that takes the resource and returns False (or raises)
+    if it can't be used anymore. Called once per task, when the task requests the resource for the first time.
+    :param close: optional callable that takes the resource and releases it when it is discarded.
+    :return:
+    """
+
+    def actual_decorator(f):
+        if name in _resource_factories:
+            raise ImproperlyConfigured(f"eb-sqs-worker error while trying to register resource {name}: "
+                                       f"resource with the same name is already registered with "
+                                       f"factory {_resource_factories[name][0]}")
+
+        _resource_factories[name] = (f, health_check, close)
+        return f
+
+    return actual_decorator
+
+
+def _get_cache():
+    if not hasattr(_local, "resources"):
+        _local.resources = {}
+        _local.checked = set()
+    return _local.resources
+
+
+def get_resource(name):
+    """
+    :return: cached resource registered under the name, the resource is (re)created if it's not cached yet
+    or failed the health check.
+    """
+    try:
+        factory, health_check, close = _resource_factories[name]
+    except KeyError:
+        raise ImproperlyConfigured(f"Resource named {name} is not registered, use @worker.resource decorator")
+
+    resources = _get_cache()
+
+    if name in resources and health_check and name not in _local.checked:
+        try:
+            healthy = health_check(resources[name])
+        except Exception as e:
+            logger.warning(f"Health check of resource {name} failed: {e}", exc_info=True)
+            healthy = False
+
+        if not healthy:
+            discard_resource(name)
+
+    if name not in resources:
+        resources[name] = factory()
+
+    _local.checked.add(name)
+
+    return resources[name]
+
+
+def discard_resource(name):
+    """
+    Removes resource from the cache of the current thread, so it will be created again on next request.
+    """
+    resources = _get_cache()
+    _local.checked.discard(name)
+
+    if name not in resources:
+        return
+
+    resource_instance = resources.pop(name)
+    close = _resource_factories[name][2]
+
+    if close:
+        try:
+            close(resource_instance)
+        except Exception as e:
+            logger.warning(f"Failed to close resource {name}: {e}", exc_info=True)
+
+
+def close_resources():
+    """
+    Closes and discards all resources cached in the current thread.
+    """
+    for name in list(_get_cache().keys()):
+        discard_resource(name)
+
+
+def task_started(task):
+    """
+    Called by worker entry points before running the task.
+    Failures of start hooks are propagated, so the task is not run and the message is redelivered.
+    """
+    global _worker_started
+
+    if not _worker_started:
+        with _worker_start_lock:
+            if not _worker_started:
+                for hook in _worker_start_hooks:
+                    hook()
+                _worker_started = True
+
+    # health checks are run again for resources requested by the new task
+    _get_cache()
+    _local.checked.clear()
+
+    for hook in _task_start_hooks:
+        hook(task)
+
+
+def task_finished(task, result=None, exception=None):
+    """
+    Called by worker entry points after running the task.
+    Failures of end hooks are only logged, so a task that already ran is not redelivered because of them.
+    """
+    for hook in _task_end_hooks:
+        try:
+            hook(task, result, exception)
+        except Exception as e:
+            logger.error(f"on_task_end hook {hook} failed for task {task.task_name}: {e}", exc_info=True)